@@ -0,0 +1,83 @@
+# Request parsing hot path. It is kept free of I/O and fully annotated so it can be
+# compiled with mypyc (`mypyc app/_parser.py`); app.main imports it the same way
+# whether or not the compiled extension is present.
+from __future__ import annotations
+from dataclasses import dataclass
+from collections.abc import Buffer
+from enum import Enum
+
+CRLF = "\r\n"
+CRLF_B = CRLF.encode()
+SUPPORTED_ENCODINGS = frozenset({b"gzip"})
+
+
+class HTTPHeader(Enum):
+    HOST = "Host"
+    USER_AGENT = "User-Agent"
+    ACCEPT = "Accept"
+    ACCEPT_ENCODING = "Accept-Encoding"
+    CONNECTION = "Connection"
+    CONTENT_ENCODING = "Content-Encoding"
+    CONTENT_TYPE = "Content-Type"
+    CONTENT_LENGTH = "Content-Length"
+
+
+# Request header names are lower-cased once while parsing, so lookups use these lower-case keys
+H_USER_AGENT = HTTPHeader.USER_AGENT.value.lower().encode()
+H_ACCEPT_ENCODING = HTTPHeader.ACCEPT_ENCODING.value.lower().encode()
+H_CONNECTION = HTTPHeader.CONNECTION.value.lower().encode()
+H_CONTENT_TYPE = HTTPHeader.CONTENT_TYPE.value.lower().encode()
+H_CONTENT_LENGTH = HTTPHeader.CONTENT_LENGTH.value.lower().encode()
+
+
+@dataclass(slots=True)
+class Request:
+    method: bytes
+    target: str
+    headers: dict[bytes, bytes]
+    body: Buffer
+    params: str | None
+    version: bytes = b"HTTP/1.1"
+    # Content encoding negotiated from Accept-Encoding, if any of the offered ones is supported
+    encoding: bytes | None = None
+
+
+def extract_params(requested_target: str) -> tuple[str, str | None]:
+    i = requested_target.rfind("/")
+    if i <= 0:
+        return requested_target, None
+    return requested_target[:i], requested_target[i + 1:]
+
+
+def parse_request(req: bytes) -> Request:
+    # All scanning goes through bytes.find, which runs in C (memchr) rather than per-byte Python code
+    eol: int = req.find(CRLF_B)
+    method_end: int = req.find(b" ", 0, eol)
+    target_end: int = req.find(b" ", method_end + 1, eol)
+    # Both separators must be present and enclose a non-empty target, otherwise the slices below are garbage
+    if method_end == -1 or target_end == -1 or target_end == method_end + 1:
+        raise ValueError(f"Malformed request line: {req[:eol]!r}")
+    raw_method = req[:method_end]
+    raw_target = req[method_end + 1:target_end].decode()
+    version = req[target_end + 1:eol]
+
+    target, maybe_params = extract_params(raw_target)
+
+    headers: dict[bytes, bytes] = {}
+    pos: int = eol + 2
+    # Walk the header block line by line until the empty line that ends it
+    while (eol := req.find(CRLF_B, pos)) > pos:
+        # Field values may have any amount of optional whitespace around them, including none
+        sep = req.find(b":", pos, eol)
+        if sep != -1:
+            headers[req[pos:sep].lower()] = req[sep + 1:eol].strip(b" \t")
+        pos = eol + 2
+
+    encoding: bytes | None = None
+    if (accept_encoding := headers.get(H_ACCEPT_ENCODING)) is not None:
+        encoding = next(iter(SUPPORTED_ENCODINGS.intersection(accept_encoding.split(b", "))), None)
+
+    # The body is handed over as a view so it is never copied or decoded here
+    body = memoryview(req)[pos + 2:] if eol == pos else memoryview(b"")
+
+    return Request(raw_method, target, headers, body, maybe_params, version, encoding)
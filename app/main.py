@@ -5,67 +5,133 @@ from asyncio.streams import StreamReader, StreamWriter
 from dataclasses import dataclass
 from enum import Enum
 import gzip
-from collections.abc import Callable, Coroutine
-from typing import Any, ParamSpec
+import inspect
+import os
+import socket
+from collections.abc import Buffer, Callable, Coroutine
+from typing import Any, BinaryIO, NamedTuple, ParamSpec
+
+from app._parser import (
+    H_CONNECTION,
+    H_CONTENT_LENGTH,
+    H_CONTENT_TYPE,
+    H_USER_AGENT,
+    SUPPORTED_ENCODINGS,
+    HTTPHeader,
+    Request,
+    parse_request,
+)
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-CRLF = "\r\n"
 RESP_LINE_200 = b"HTTP/1.1 200 OK"
 RESP_LINE_201 = b"HTTP/1.1 201 Created"
-SUPPORTED_ENCODINGS = ["gzip"]
+# Responses that never vary are built once and reused as-is
+RESP_200_EMPTY = b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n"
+RESP_200_CLOSE = b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n"
+RESP_400_BAD_REQUEST = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n"
+RESP_404_NOT_FOUND = b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n"
+RESP_431_HEADERS_TOO_LARGE = b"HTTP/1.1 431 Request Header Fields Too Large\r\nContent-Length: 0\r\n\r\n"
 
-def extract_params(requested_target: str) -> str | None:
-    if requested_target.count("/") == 1:
-        return None
-    return requested_target.split("/")[-1]
 
+def open_file(path: str) -> FileBody:
+    f = open(path, "rb")
+    return FileBody(f, os.fstat(f.fileno()).st_size)
 
-class HTTPHeader(Enum):
-    HOST = "Host"
-    USER_AGENT = "User-Agent"
-    ACCEPT = "Accept"
-    ACCEPT_ENCODING = "Accept-Encoding"
-    CONNECTION = "Connection"
-    CONTENT_ENCODING = "Content-Encoding"
-    CONTENT_TYPE = "Content-Type"
-    CONTENT_LENGTH = "Content-Length"
+
+def write_file(path: str, data: Buffer) -> None:
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+# Response header lines keep the canonical spelling
+CONTENT_TYPE_LINE = HTTPHeader.CONTENT_TYPE.value.encode() + b": %b\r\n"
+CONTENT_ENCODING_LINES = {
+    enc: HTTPHeader.CONTENT_ENCODING.value.encode() + b": " + enc + b"\r\n" for enc in SUPPORTED_ENCODINGS
+}
+# Status line, optional Content-Type and Content-Encoding lines, Content-Length and body, filled in one go
+RESP_TEMPLATE = b"%b\r\n%b%b" + HTTPHeader.CONTENT_LENGTH.value.encode() + b": %d\r\n\r\n%b"
 
 
 class HTTPMethod(Enum):
-    GET = "GET"
-    POST = "POST"
-    PUT = "PUT"
-    PATCH = "PATCH"
-    DELETE = "DELETE"
+    GET = b"GET"
+    POST = b"POST"
+    PUT = b"PUT"
+    PATCH = b"PATCH"
+    DELETE = b"DELETE"
+
 
+@dataclass(slots=True)
+class FileBody:
+    file: BinaryIO
+    size: int
 
-@dataclass
-class Request:
-    method: HTTPMethod
-    target: str
-    headers: dict[str, str]
-    body: str
-    params: str | None
-    version: str = "HTTP/1.1"
 
+@dataclass(slots=True)
+class FileResponse:
+    head: bytes
+    body: FileBody
 
-class TargetNotFoundException(Exception):
-    pass
 
-class MissingParamsException(Exception):
-    pass
+# Handlers report their outcome as a value instead of raising, which keeps
+# exception machinery off the ordinary 400/404 paths
+class RouteResult(NamedTuple):
+    status: int
+    body: bytes | FileBody
+    # Content encoding the handler actually applied to body, if any
+    encoding: bytes | None = None
 
-class MissingHeaderException(Exception):
-    pass
 
-class ResourceNotFoundException(Exception):
-    pass
+RESULT_EMPTY = RouteResult(200, b"")
+RESULT_CREATED = RouteResult(201, b"")
+RESULT_BAD_REQUEST = RouteResult(400, b"")
+RESULT_NOT_FOUND = RouteResult(404, b"")
 
-type Route = Callable[..., Coroutine[Any, Any, bytes]]
+type Response = bytes | FileResponse
+type Route = Callable[..., Response | Coroutine[Any, Any, Response]]
 type RouteDirectory = dict[HTTPMethod, dict[str, Route]]
+type RouteDispatch = dict[tuple[bytes, str], Route]
 TArgs = ParamSpec("TArgs")
 
+class ResponseWriter:
+    # Queues responses and hands everything produced within one event-loop turn to the
+    # transport as a single write, so pipelined requests that were already buffered by
+    # the reader are answered together instead of with one send per response
+    def __init__(self, writer: StreamWriter) -> None:
+        self.writer = writer
+        self.pending: list[bytes] = []
+
+    def write(self, data: bytes) -> None:
+        if not self.pending:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.pending.append(data)
+
+    def flush(self) -> None:
+        if self.pending:
+            self.writer.write(b"".join(self.pending))
+            self.pending.clear()
+
+    async def close(self, data: bytes) -> None:
+        # Sends a final response along with anything still queued, then closes the connection
+        self.write(data)
+        self.flush()
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def drain(self) -> None:
+        # Small responses fit in the transport buffer, so only wait for it to flush past the
+        # high-water mark; responses still queued here count towards it as well
+        transport = self.writer.transport
+        if transport.get_write_buffer_size() + sum(map(len, self.pending)) > transport.get_write_buffer_limits()[1]:
+            self.flush()
+            await self.writer.drain()
+
+
 class HTTPServer:
-    def __init__(self, port: int, directory: str, bufsize: int = 1024) -> None:
+    def __init__(self, port: int, directory: str, bufsize: int = 65536) -> None:
         self.port = port
         self.directory = directory
         self.bufsize = bufsize
@@ -80,167 +146,188 @@ class HTTPServer:
                 "/files": self.post_file, 
             }
         }
+        # Flattened view of self.routes keyed on the raw method bytes, so dispatch is a single lookup
+        self._dispatch: RouteDispatch = {
+            (method.value, target): route
+            for method, targets in self.routes.items()
+            for target, route in targets.items()
+        }
 
     async def start(self) -> None:
-        server = await asyncio.start_server(self.handle_client, "localhost", self.port)
+        # bufsize caps how much the stream reader buffers while looking for the end of the headers
+        server = await asyncio.start_server(self.handle_client, "localhost", self.port, limit=self.bufsize)
         print("Started server")
         async with server:
             await server.serve_forever()
 
     @staticmethod
-    async def make_bad_request(status_code: int, reason: str) -> bytes:
-        return f"HTTP/1.1 {status_code} {reason}{CRLF}{CRLF}".encode()
+    def route(declared_content_type: str = "text/plain") -> Callable[[Route], Route]:
+        declared_content_type_line = CONTENT_TYPE_LINE % declared_content_type.encode()
+
+        def respond(request: Request, result: RouteResult) -> Response:
+            status, ret, encoding = result
+            if status == 200:
+                if not ret and encoding is None and H_CONTENT_TYPE not in request.headers:
+                    return RESP_200_EMPTY
+                status_line = RESP_LINE_200
+            elif status == 201:
+                status_line = RESP_LINE_201
+            elif status == 400:
+                return RESP_400_BAD_REQUEST
+            elif status == 404:
+                return RESP_404_NOT_FOUND
+            else:
+                raise ValueError(f"Return code {status} not supported")
 
-    @staticmethod
-    def route(retcode: int = 200, declared_content_type: str = "text/plain") -> Callable[[Route], Route]:
-        def decorator(func: Route) -> Route:
-            async def wrapper(self: Any, request: Request) -> bytes:
-                try:
-                    ret = await func(self, request)
-                except (MissingParamsException, MissingHeaderException):
-                    return await HTTPServer.make_bad_request(status_code=400, reason="Bad Request")
-                except ResourceNotFoundException:
-                    return await HTTPServer.make_bad_request(status_code=404, reason="Not Found")
-
-                if retcode == 200:
-                    resp = RESP_LINE_200
-                elif retcode == 201:
-                    resp = RESP_LINE_201
-                else:
-                    raise ValueError(f"Return code {retcode} not supported")
-
-                resp += CRLF.encode()
-
-                if (requested_content_type := request.headers.get(HTTPHeader.CONTENT_TYPE.value)) is not None:
-                    resp += f"{HTTPHeader.CONTENT_TYPE.value}: {requested_content_type}{CRLF}".encode()
-                elif requested_content_type is None and len(ret) > 0:
-                    # If not set by the client, we set it ourselves 
-                    resp += f"{HTTPHeader.CONTENT_TYPE.value}: {declared_content_type}{CRLF}".encode()
-                else:
-                    pass
-
-                if (requested_content_encoding_raw := request.headers.get(HTTPHeader.ACCEPT_ENCODING.value)) is not None:
-                    requested_content_encodings = requested_content_encoding_raw.split(", ")
-                    try:
-                        content_encoding_match = next(filter(lambda enc: enc in SUPPORTED_ENCODINGS, requested_content_encodings))
-                        resp += f"{HTTPHeader.CONTENT_ENCODING.value}: {content_encoding_match}{CRLF}".encode()
-                    except StopIteration:
-                        print("None of the requested encodings are supported")
+            body_len = ret.size if isinstance(ret, FileBody) else len(ret)
+
+            if (requested_content_type := request.headers.get(H_CONTENT_TYPE)) is not None:
+                content_type_line = CONTENT_TYPE_LINE % requested_content_type
+            elif body_len > 0:
+                # If not set by the client, we set it ourselves 
+                content_type_line = declared_content_type_line
+            else:
+                content_type_line = b""
 
-                resp += f"{HTTPHeader.CONTENT_LENGTH.value}: {len(ret)}{CRLF}".encode()
-                resp += CRLF.encode()
+            encoding_line = b"" if encoding is None else CONTENT_ENCODING_LINES[encoding]
 
-                resp += ret
+            if isinstance(ret, FileBody):
+                return FileResponse(RESP_TEMPLATE % (status_line, content_type_line, encoding_line, body_len, b""), ret)
+            return RESP_TEMPLATE % (status_line, content_type_line, encoding_line, body_len, ret)
 
-                return resp
+        def decorator(func: Route) -> Route:
+            # Handlers that never await stay plain functions, so they don't pay for a coroutine per request
+            if inspect.iscoroutinefunction(func):
+                async def async_wrapper(self: Any, request: Request) -> Response:
+                    return respond(request, await func(self, request))
+                return async_wrapper
+
+            def wrapper(self: Any, request: Request) -> Response:
+                return respond(request, func(self, request))
             return wrapper
         return decorator
 
     @route()
-    async def home(self, request: Request) -> bytes:
-        return b""
+    def home(self, request: Request) -> RouteResult:
+        return RESULT_EMPTY
 
     @route()
-    async def echo(self, request: Request) -> bytes:
+    def echo(self, request: Request) -> RouteResult:
         params = request.params
         if params is None:
-            raise MissingParamsException
+            return RESULT_BAD_REQUEST
 
-        if request.headers.get(HTTPHeader.ACCEPT_ENCODING.value) == "gzip":
-            return gzip.compress(params.encode())
-        return params.encode()
+        if request.encoding == b"gzip":
+            return RouteResult(200, gzip.compress(params.encode()), b"gzip")
+        return RouteResult(200, params.encode())
 
     @route(declared_content_type="application/octet-stream")
-    async def get_file(self, request: Request) -> bytes:
+    async def get_file(self, request: Request) -> RouteResult:
         if not request.params:
-            raise MissingParamsException
+            return RESULT_BAD_REQUEST
         
         path = f"{self.directory}/{request.params}"
         try:
-            with open(path, "r") as f:
-                content = f.read().encode()
-        except:
-            raise ResourceNotFoundException
-        
-        return content
+            # Disk I/O runs in the default executor so it doesn't stall other clients
+            return RouteResult(200, await asyncio.get_running_loop().run_in_executor(None, open_file, path))
+        except OSError:
+            return RESULT_NOT_FOUND
     
-    @route(retcode=201, declared_content_type="application/octet-stream")
-    async def post_file(self, request: Request) -> bytes:
+    @route(declared_content_type="application/octet-stream")
+    async def post_file(self, request: Request) -> RouteResult:
         if not request.params:
-            raise MissingParamsException
+            return RESULT_BAD_REQUEST
         
         path = f"{self.directory}/{request.params}"
-        with open(path, "w") as f:
-            f.write(request.body)
-        return b"" # TODO should be able to return None
+        await asyncio.get_running_loop().run_in_executor(None, write_file, path, request.body)
+        return RESULT_CREATED
         
 
     @route()
-    async def user_agent(self, request: Request) -> bytes:
-        try:
-            user_agent = request.headers[HTTPHeader.USER_AGENT.value]
-        except KeyError:
-            raise MissingHeaderException
-        return user_agent.encode()
-
-    async def parse_request(self, req: bytes) -> Request:
-        data = req.decode().split(CRLF)
-        req_line = data.pop(0)
-        raw_method, raw_target, version = req_line.split(" ")
-
-        maybe_params = extract_params(raw_target)
-        if maybe_params is not None:
-            target = raw_target.removesuffix(f"/{maybe_params}")
+    def user_agent(self, request: Request) -> RouteResult:
+        if (user_agent := request.headers.get(H_USER_AGENT)) is None:
+            return RESULT_BAD_REQUEST
+        return RouteResult(200, user_agent)
+
+    async def send_file(self, out: ResponseWriter, resp: FileResponse) -> bool:
+        # Returns False if the client went away mid-transfer
+        loop = asyncio.get_running_loop()
+        writer = out.writer
+        with resp.body.file as f:
+            try:
+                # Anything still queued has to go out first, and sendfile needs the
+                # transport's write buffer to be empty before it takes over the socket
+                out.flush()
+                writer.write(resp.head)
+                await writer.drain()
+                # An empty file is fully described by its header block, and sendfile rejects count=0
+                if resp.body.size > 0:
+                    try:
+                        # Zero-copy sendfile(2) where the transport supports it, buffered read/write otherwise
+                        await loop.sendfile(writer.transport, f, count=resp.body.size)
+                    except NotImplementedError:
+                        # Loops without sendfile at all (e.g. uvloop) get the file streamed through the writer,
+                        # stopping at the size already sent as Content-Length even if the file has grown since
+                        remaining = resp.body.size
+                        while remaining and (chunk := await loop.run_in_executor(None, f.read, min(self.bufsize, remaining))):
+                            writer.write(chunk)
+                            remaining -= len(chunk)
+                            await out.drain()
+            except ConnectionError:
+                print(f"Client disconnected")
+                writer.close()
+                return False
+        return True
+
+    async def handle_request(self, request: Request, out: ResponseWriter) -> bool:
+        # Returns False once the connection has been closed
+        route = self._dispatch.get((request.method, request.target))
+        if route is None:
+            out.write(RESP_404_NOT_FOUND)
+        elif request.headers.get(H_CONNECTION) == b"close":
+            await out.close(RESP_200_CLOSE)
+            return False
         else:
-            target = raw_target
-
-        method = HTTPMethod(raw_method)
-        if not target in self.routes[method]:
-            raise TargetNotFoundException
-
-        headers: dict[str, str] = {}
-        body: str = ""
-        for line in data:
-            if ": " in line:
-                k, v = line.split(": ")
-                headers[k] = v
-            elif line == "":
-                continue
+            resp = route(request)
+            if inspect.iscoroutine(resp):
+                resp = await resp
+            if isinstance(resp, FileResponse):
+                return await self.send_file(out, resp)
             else:
-                body = line
-
-        return Request(method, target, headers, body, maybe_params, version)
-
-    async def make_closed_response(self) -> bytes:
-        resp = RESP_LINE_200
-        resp += CRLF.encode()
-        resp += f"{HTTPHeader.CONNECTION.value}: close".encode()
-        resp += CRLF.encode()
-        resp += CRLF.encode()
-        return resp
+                out.write(resp)
+        return True
 
     async def handle_client(self, reader: StreamReader, writer: StreamWriter) -> None:
+        # Responses are mostly tiny, so don't let Nagle hold them back waiting for an ACK
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        out = ResponseWriter(writer)
         while True:
-            raw_data = await reader.read(self.bufsize)
-            if not raw_data:
+            # The stream reader keeps whatever follows this request buffered, so
+            # pipelined requests are picked up by the next iteration
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request = parse_request(head)
+                raw_content_length = request.headers.get(H_CONTENT_LENGTH, b"0")
+                # Only plain digits frame the body; int() would also take signs, spaces and underscores
+                if not raw_content_length.isdigit():
+                    raise ValueError(f"Invalid Content-Length: {raw_content_length!r}")
+                if (content_length := int(raw_content_length)) > 0:
+                    request.body = memoryview(await reader.readexactly(content_length))
+            except asyncio.IncompleteReadError:
                 print(f"Client disconnected")
                 break
-            try:
-                request = await self.parse_request(raw_data)
-            except TargetNotFoundException:
-                writer.write(await HTTPServer.make_bad_request(404, "Not Found"))
-                await writer.drain()
-            else:
-                if request.headers.get(HTTPHeader.CONNECTION.value) == "close":
-                    resp = await self.make_closed_response()
-                    writer.write(resp)
-                    writer.close()
-                    await writer.wait_closed()
-                else:
-                    func = self.routes[request.method][request.target]
-                    resp = await func(request)
-                    writer.write(resp)
-                    await writer.drain()
+            except asyncio.LimitOverrunError:
+                # The header block outgrew bufsize before its terminating empty line showed up
+                await out.close(RESP_431_HEADERS_TOO_LARGE)
+                break
+            except ValueError:
+                # Malformed request line or Content-Length; the stream can't be framed past this point
+                await out.close(RESP_400_BAD_REQUEST)
+                break
+
+            if not await self.handle_request(request, out):
+                break
+            await out.drain()
 
 
 if __name__ == "__main__":
@@ -248,4 +335,8 @@ if __name__ == "__main__":
     parser.add_argument("--directory")
     args = parser.parse_args()
     server = HTTPServer(port=4221, directory=args.directory)
-    asyncio.run(server.start())
+    # uvloop's libuv-based event loop is a drop-in replacement with much lower per-callback overhead
+    if uvloop is not None:
+        uvloop.run(server.start())
+    else:
+        asyncio.run(server.start())